@@ -8,62 +8,164 @@ from datetime import datetime, timezone, timedelta
 import pandas as pd
 import numpy as np
 import io
-from time import sleep as slp 
+import time
+import threading
 import json 
 import urllib.parse 
 import os 
+import pickle
+import importlib.util
 import requests # ★urllib.request, urllib.error の代わりに使用
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- 設定 ---
 GTFS_RT_URL = 'http://akita.bustei.net/TripUpdate.pb'
 JST = timezone(timedelta(hours=+9))
 APP_PORT = 5000
 TIMEOUT_SECONDS = 15 # GTFS-RTのタイムアウト時間 (接続+読み込み)
+RT_MAX_RETRIES = 2 # GTFS-RT取得の再試行回数 (初回を含め最大3回)
+RT_CACHE_TTL_SECONDS = 20 # 取得したGTFS-RTを使い回す時間
+SCHEDULE_CACHE_SECONDS = 10 # バス停ごとの運行表を使い回す時間
+
+# GTFS-RT取得用の共有セッション (リクエスト毎のTCP接続確立を省く)
+RT_SESSION = requests.Session()
+RT_SESSION.headers['User-Agent'] = 'Mozilla/5.0'
+# 接続エラー・タイムアウト・5xxは指数バックオフ付きで再試行する
+RT_RETRY = Retry(total=RT_MAX_RETRIES, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+RT_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=RT_RETRY))
+RT_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=RT_RETRY))
+
+# --- 運行状況コード (judge_status_codes の判定結果) ---
+STATUS_ARRIVING_ON_TIME = 0 # RTあり: 定刻で到着見込み
+STATUS_ARRIVING = 1         # RTあり: 遅れ/早着で到着見込み
+STATUS_PASSED = 2           # RTあり: 通過・到着済み
+STATUS_NOT_STARTED = 3      # RTなし: 運行開始前
+STATUS_FINISHED = 4         # RTなし: 運行終了
+STATUS_PASSED_NO_INFO = 5   # RTなし: 通過済み（情報なし）
+STATUS_LABELS = np.array([None, None, '通過・到着済み', '運行開始前', '運行終了', '通過済み（情報なし）'], dtype=object)
 
 # --- グローバル変数（GTFS静的データ） ---
 GTFS = {}
+RT_CACHE = {'df': None, 'fetched_at': 0.0, 'etag': None, 'last_modified': None, 'next_stop': None} # 直近に取得したGTFS-RTと取得時刻・条件付きGET用の検証子・便ごとの次の停車
+RT_CACHE_LOCK = threading.Lock()
+SCHEDULE_CACHE = {} # バス停名 -> (運行表, 生成時刻)
+SERVICE_IDS_CACHE = {} # 日付 (YYYYMMDD) -> その日の有効service_id (当日分のみ保持)
+SCHEDULE_CACHE_LOCK = threading.Lock()
 GTFS_FILES = ['stop_times.txt', 'trips.txt', 'stops.txt', 'routes.txt', 'calendar.txt', 'calendar_dates.txt']
-
-
-def extract_parent_id(stop_id):
-    """'mytown0003_01' -> 'mytown0003' のように、枝番を除いた親IDを抽出する"""
-    if pd.isna(stop_id):
-        return None
-    return stop_id.rsplit('_', 1)[0]
-
-def extract_parent_route_id(route_id):
-    """'A_1' -> 'A' のように、'_' の前の親ルートIDを抽出する"""
-    if pd.isna(route_id):
-        return None
-    return route_id.split('_', 1)[0]
-
-def time_to_seconds(time_str):
-    """'HH:MM:SS'形式の時刻文字列を秒単位に変換する (24時間超え対応)"""
+WEEKDAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+EMPTY_SERVICES = np.array([], dtype=object)
+# stop_times.txt はpyarrowがあればマルチスレッドで読み込む (未インストール時はCエンジン)
+STOP_TIMES_CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+# 親バス停ごとの時刻表 (SCHEDULE_BY_PARENT) に保持する列
+SCHEDULE_COLUMNS = ['trip_id', 'service_id', 'departure_time', 'departure_sec', 'trip_headsign']
+GTFS_CACHE_PATH = 'gtfs_cache.pkl' # 前処理済みGTFSのスナップショット (元ファイル更新時に再生成)
+
+
+def extract_parent_id(stop_ids):
+    """'mytown0003_01' -> 'mytown0003' のように、枝番を除いた親IDを列単位で抽出する"""
+    return stop_ids.str.rsplit('_', n=1).str[0]
+
+def extract_parent_route_id(route_ids):
+    """'A_1' -> 'A' のように、'_' の前の親ルートIDを列単位で抽出する"""
+    return route_ids.str.split('_', n=1).str[0]
+
+def time_to_seconds(time_series):
+    """'HH:MM:SS'形式の時刻文字列の列を秒単位に一括変換する (24時間超え対応、不正値はNaN)"""
+    parts = time_series.str.split(':', expand=True)
+    h = pd.to_numeric(parts[0], errors='coerce')
+    m = pd.to_numeric(parts[1], errors='coerce')
+    s = pd.to_numeric(parts[2], errors='coerce')
+    return (h * 3600 + m * 60 + s).astype('float32')
+
+def to_shared_category(frames, column):
+    """複数のDataFrameにまたがるID列を、共通のカテゴリ定義を持つcategory型に変換する (merge/isinを整数コードで処理させる)"""
+    categories = sorted(set().union(*(df[column].dropna().unique() for df in frames)))
+    dtype = pd.CategoricalDtype(categories)
+    for df in frames:
+        df[column] = df[column].astype(dtype)
+
+def get_gtfs_source_mtimes():
+    """キャッシュの有効性判定用に、GTFS元ファイルと本モジュールの更新時刻、pandas/numpyのバージョンを取得する"""
+    mtimes = {f: os.path.getmtime(os.path.join('gtfs_data', f)) for f in GTFS_FILES}
+    mtimes[os.path.basename(__file__)] = os.path.getmtime(__file__)
+    # 別バージョンのpandas/numpyで保存したpickleは使い回さず再構築する
+    mtimes['pandas'] = pd.__version__
+    mtimes['numpy'] = np.__version__
+    return mtimes
+
+def load_gtfs_cache():
+    """元ファイルが更新されていなければ、前処理済みスナップショットからGTFSを復元する"""
+    try:
+        with open(GTFS_CACHE_PATH, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('mtimes') != get_gtfs_source_mtimes():
+            return False
+        GTFS.update(cached['GTFS'])
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print(f"GTFSキャッシュの読み込みに失敗しました。CSVから再構築します: {e}")
+        return False
+
+def save_gtfs_cache():
+    """前処理済みGTFSを元ファイルの更新時刻とともにスナップショットとして保存する"""
     try:
-        h, m, s = map(int, time_str.split(':'))
-        return h * 3600 + m * 60 + s
-    except:
-        return np.nan
+        tmp_path = GTFS_CACHE_PATH + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'GTFS': GTFS, 'mtimes': get_gtfs_source_mtimes()}, f, protocol=5)
+        os.replace(tmp_path, GTFS_CACHE_PATH)
+    except Exception as e:
+        print(f"GTFSキャッシュの保存に失敗しました: {e}")
 
 def load_gtfs_data():
     """GTFS静的データをPandas DataFrameとしてメモリにロードし、必要なマッピングを作成する"""
     print("GTFS静的データをロード中...")
     global GTFS
+    with SCHEDULE_CACHE_LOCK:
+        SCHEDULE_CACHE.clear()
+    SERVICE_IDS_CACHE.clear()
+    if load_gtfs_cache():
+        print("GTFSキャッシュからロードしました。")
+        return
     try:
-        df_st = pd.read_csv('gtfs_data/stop_times.txt', dtype={'trip_id': str, 'stop_id': str, 'stop_sequence': int})
-        df_st['departure_sec'] = df_st['departure_time'].apply(time_to_seconds)
-        df_st['arrival_sec'] = df_st['arrival_time'].apply(time_to_seconds)
-
-        df_t = pd.read_csv('gtfs_data/trips.txt', dtype={'route_id': str, 'service_id': str, 'trip_id': str})
-        df_s = pd.read_csv('gtfs_data/stops.txt', dtype={'stop_id': str})
-        df_r = pd.read_csv('gtfs_data/routes.txt', dtype={'route_id': str})
-        df_r['parent_route_id'] = df_r['route_id'].apply(extract_parent_route_id)
-        df_c = pd.read_csv('gtfs_data/calendar.txt', dtype={'service_id': str})
-        df_cd = pd.read_csv('gtfs_data/calendar_dates.txt', dtype={'service_id': str, 'date': str, 'exception_type': int})
+        # 各ファイルは運行表の生成で参照する列だけを読み込む
+        df_st = pd.read_csv('gtfs_data/stop_times.txt',
+            engine=STOP_TIMES_CSV_ENGINE,
+            usecols=['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'],
+            dtype={'trip_id': str, 'arrival_time': str, 'departure_time': str, 'stop_id': str, 'stop_sequence': np.int32})
+        df_st['departure_sec'] = time_to_seconds(df_st['departure_time'])
+        df_st['arrival_sec'] = time_to_seconds(df_st['arrival_time'])
+
+        df_t = pd.read_csv('gtfs_data/trips.txt',
+            usecols=['route_id', 'service_id', 'trip_id', 'trip_headsign'],
+            dtype={'route_id': str, 'service_id': str, 'trip_id': str})
+        df_s = pd.read_csv('gtfs_data/stops.txt', usecols=['stop_id', 'stop_name'], dtype={'stop_id': str})
+        df_r = pd.read_csv('gtfs_data/routes.txt', usecols=['route_id'], dtype={'route_id': str})
+        df_r['parent_route_id'] = extract_parent_route_id(df_r['route_id'])
+        df_c = pd.read_csv('gtfs_data/calendar.txt',
+            usecols=lambda column: column == 'service_id' or column in WEEKDAY_NAMES,
+            dtype={'service_id': str})
+        df_cd = pd.read_csv('gtfs_data/calendar_dates.txt',
+            usecols=['service_id', 'date', 'exception_type'],
+            dtype={'service_id': str, 'date': str, 'exception_type': np.int8})
 
         # --- マッピング作成 ---
-        df_s['parent_id'] = df_s['stop_id'].apply(extract_parent_id)
-        parent_id_map = df_s.drop_duplicates(subset=['parent_id']).set_index('stop_name')['parent_id'].to_dict()
+        df_s['parent_id'] = extract_parent_id(df_s['stop_id'])
+
+        # 繰り返し出現する文字列IDはcategory型に変換し、フレーム間でカテゴリを揃えておく
+        to_shared_category([df_st, df_t], 'trip_id')
+        to_shared_category([df_st, df_s], 'stop_id')
+        to_shared_category([df_t, df_c, df_cd], 'service_id')
+        to_shared_category([df_t, df_r], 'route_id')
+        to_shared_category([df_s], 'parent_id')
+        to_shared_category([df_r], 'parent_route_id')
+        to_shared_category([df_t], 'trip_headsign')
+
+        # 同名の親バス停が複数ある場合は従来どおり後に出現するものを採用する
+        df_stops_by_name = df_s.drop_duplicates(subset=['stop_name'], keep='last')
+        parent_id_map = dict(zip(df_stops_by_name['stop_name'].to_numpy(), df_stops_by_name['parent_id'].to_numpy()))
 
         df_route_stops = df_st[['trip_id', 'stop_id']].drop_duplicates()
         df_route_stops = df_route_stops.merge(df_t[['trip_id', 'route_id']], on='trip_id', how='left')
@@ -72,25 +174,53 @@ def load_gtfs_data():
         df_final_mapping = df_route_stops[['parent_route_id', 'stop_name']].dropna().drop_duplicates()
 
         route_stop_map = {}
-        for parent_route_id, group in df_final_mapping.groupby('parent_route_id'):
+        for parent_route_id, group in df_final_mapping.groupby('parent_route_id', observed=True):
             sorted_stops = sorted(group['stop_name'].unique().tolist())
             route_stop_map[parent_route_id] = sorted_stops
 
-        df_min_max_times = df_st.groupby('trip_id')['departure_sec'].agg(['min', 'max']).reset_index()
-        df_min_max_times.rename(columns={'min': 'dep_sec', 'max': 'arr_sec'}, inplace=True)
+        # 親バス停ごとの時刻表 (便の行先・service_idを結合済み、出発時刻順) を事前に作成し、リクエスト毎のmergeを不要にする
+        df_st_by_parent = df_st.merge(
+            df_s[['stop_id', 'parent_id']], on='stop_id', how='inner'
+        ).merge(
+            df_t[['trip_id', 'service_id', 'trip_headsign']], on='trip_id', how='inner'
+        ).sort_values('departure_sec', kind='stable')
+        schedule_by_parent = {
+            parent_id: group[SCHEDULE_COLUMNS].reset_index(drop=True)
+            for parent_id, group in df_st_by_parent.groupby('parent_id', sort=False, observed=True)
+        }
+
+        # 曜日ごとの運行service_id、および日付ごとの例外 (追加, 運休) を配列として事前に作成する
+        services_by_day = {
+            day_name: df_c.loc[df_c[day_name] == 1, 'service_id'].to_numpy()
+            for day_name in WEEKDAY_NAMES if day_name in df_c.columns
+        }
+        service_exceptions_by_date = {
+            date: (
+                group.loc[group['exception_type'] == 1, 'service_id'].to_numpy(),
+                group.loc[group['exception_type'] == 2, 'service_id'].to_numpy()
+            )
+            for date, group in df_cd.groupby('date', sort=False)
+        }
+
+        # 便ごとの終点時刻 (運行終了判定に使用): stop_sequence順に並べた各便の最終行の時刻
+        df_trip_seq = df_st[['trip_id', 'stop_sequence', 'departure_sec']].sort_values(['trip_id', 'stop_sequence'])
+        trip_arr_sec = df_trip_seq.groupby('trip_id', sort=False, observed=True)['departure_sec'].last().to_dict()
 
-        # グローバル辞書に格納
-        GTFS['STOP_TIMES'] = df_st
-        GTFS['TRIPS'] = df_t
-        GTFS['STOPS'] = df_s
-        GTFS['CALENDAR'] = df_c
-        GTFS['CALENDAR_DATES'] = df_cd
+        # グローバル辞書に格納 (リクエスト処理で参照する派生データのみ。元のテーブルは保持しない)
+        GTFS['SERVICES_BY_DAY'] = services_by_day
+        GTFS['SERVICE_EXCEPTIONS_BY_DATE'] = service_exceptions_by_date
         GTFS['PARENT_ID_MAP'] = parent_id_map 
-        GTFS['TRIP_BOUNDARIES'] = df_min_max_times
+        GTFS['TRIP_ARR_SEC'] = trip_arr_sec
         GTFS['ROUTE_STOP_MAP'] = route_stop_map 
         GTFS['ROUTE_NAMES'] = sorted(route_stop_map.keys()) 
-        GTFS['STOP_NAME_MAP'] = df_s.set_index('stop_id')['stop_name'].to_dict()
-        
+        GTFS['SCHEDULE_BY_PARENT'] = schedule_by_parent
+        GTFS['TRIP_SEQ_STOP'] = dict(zip(zip(df_st['trip_id'], df_st['stop_sequence']), df_st['stop_id']))
+        # stop_id -> stop_name はSeriesで持ち、リクエスト毎のmapで辞書からの変換が起きないようにする
+        df_stop_names = df_s.drop_duplicates('stop_id', keep='last')
+        GTFS['STOP_NAME_SERIES'] = pd.Series(
+            df_stop_names['stop_name'].to_numpy(dtype=object), index=df_stop_names['stop_id'].to_numpy(dtype=object)
+        )
+        save_gtfs_cache()
         print("GTFSデータのロードが完了しました。")
 
     except FileNotFoundError as e:
@@ -99,84 +229,180 @@ def load_gtfs_data():
 
 
 def get_current_service_ids(now_jst):
-    """現在の日付と曜日から有効なservice_idのリストを取得する"""
-    if 'CALENDAR' not in GTFS: return []
+    """現在の日付と曜日から有効なservice_idの配列を取得する"""
+    if 'SERVICES_BY_DAY' not in GTFS: return []
     today_date = now_jst.strftime('%Y%m%d')
+    cached = SERVICE_IDS_CACHE.get(today_date)
+    if cached is not None:
+        return cached
+
     day_name = now_jst.strftime('%A').lower()  
     
-    weekly_services = []
-    if day_name in GTFS['CALENDAR'].columns:
-        weekly_services = GTFS['CALENDAR'][GTFS['CALENDAR'][day_name] == 1]['service_id'].tolist()
-
-    exceptions = GTFS['CALENDAR_DATES'][GTFS['CALENDAR_DATES']['date'] == today_date]
-    added_services = exceptions[exceptions['exception_type'] == 1]['service_id'].tolist()
-    removed_services = exceptions[exceptions['exception_type'] == 2]['service_id'].tolist()
+    weekly_services = GTFS['SERVICES_BY_DAY'].get(day_name, EMPTY_SERVICES)
+    added_services, removed_services = GTFS['SERVICE_EXCEPTIONS_BY_DATE'].get(
+        today_date, (EMPTY_SERVICES, EMPTY_SERVICES)
+    )
 
-    active_service_ids = set(weekly_services).union(set(added_services)) - set(removed_services)
+    active_service_ids = np.setdiff1d(np.union1d(weekly_services, added_services), removed_services)
     
-    return list(active_service_ids)
+    # 結果は日付が変わるまで変わらないため、当日分だけを保持する
+    SERVICE_IDS_CACHE.clear()
+    SERVICE_IDS_CACHE[today_date] = active_service_ids
+    return active_service_ids
+
 
+def is_rt_cache_fresh():
+    """RT_CACHEの内容がRT_CACHE_TTL_SECONDS以内に取得されたものかを返す"""
+    return RT_CACHE['df'] is not None and time.monotonic() - RT_CACHE['fetched_at'] < RT_CACHE_TTL_SECONDS
 
 def get_realtime_updates():
-    """GTFS-RTデータをrequestsで取得し、DataFrameとして返す"""
-    MAX_RETRIES = 3
-    
-    for attempt in range(MAX_RETRIES):
-        try:
-            # ★requestsでアクセス（urllibからの変更点）
-            res = requests.get(
-                GTFS_RT_URL, 
-                headers={'User-Agent': 'Mozilla/5.0'}, 
-                timeout=TIMEOUT_SECONDS # 設定したタイムアウトを適用
-            )
-            res.raise_for_status() # HTTPエラー (4xx, 5xx) を例外として処理
-
-            feed = gtfs_realtime_pb2.FeedMessage()
-            feed.ParseFromString(res.content) # .content でバイナリデータを取得
-
-            updates = []
-            for entity in feed.entity:
-                if entity.HasField('trip_update'):
-                    tu = entity.trip_update
-                    trip_id = tu.trip.trip_id
-                    
-                    for stu in tu.stop_time_update:
-                        delay = 0
-                        if stu.HasField('departure') and stu.departure.HasField('delay'):
-                            delay = stu.departure.delay
-                        elif stu.HasField('arrival') and stu.arrival.HasField('delay'):
-                            delay = stu.arrival.delay
-                        
-                        if delay != 0 or stu.HasField('stop_id'):
-                            updates.append({
-                                'trip_id': trip_id,
-                                'stop_sequence': stu.stop_sequence,
-                                'delay_sec': delay,
-                                'rt_stop_id': stu.stop_id
-                            })
+    """GTFS-RTデータを返す。RT_CACHE_TTL_SECONDS以内に取得済みであればそれを使い回す"""
+    if is_rt_cache_fresh():
+        return RT_CACHE['df']
+
+    # 取得は1スレッドだけが行う。取得中に来たリクエストは前回のデータがあればそれを返す
+    if not RT_CACHE_LOCK.acquire(blocking=RT_CACHE['df'] is None):
+        return RT_CACHE['df']
+    try:
+        if is_rt_cache_fresh(): # 待っている間に他のスレッドが更新済み
+            return RT_CACHE['df']
+        df_rt = fetch_realtime_updates()
+        RT_CACHE['df'] = df_rt
+        RT_CACHE['fetched_at'] = time.monotonic()
+        return df_rt
+    finally:
+        RT_CACHE_LOCK.release()
+
+
+def get_rt_next_stops():
+    """GTFS-RTのうち時刻表にある便について、便ごとの次の停車 (最小stop_sequence) の行を返す。RTの取得ごとに一度だけ計算する"""
+    df_rt_all = get_realtime_updates()
+    cached = RT_CACHE['next_stop']
+    if cached is not None and cached[0] is df_rt_all:
+        return cached[1]
+
+    if df_rt_all.empty:
+        df_rt_next_stop = df_rt_all
+    else:
+        # 時刻表にない便はどのバス停の便とも一致しないため先に除く
+        df_rt_known = df_rt_all[df_rt_all['trip_id'].isin(GTFS.get('TRIP_ARR_SEC', {}).keys())]
+        next_stop_idx = df_rt_known.groupby('trip_id', sort=False)['stop_sequence'].idxmin()
+        df_rt_next_stop = df_rt_known.loc[next_stop_idx, ['trip_id', 'stop_sequence', 'delay_sec']]
+
+    RT_CACHE['next_stop'] = (df_rt_all, df_rt_next_stop)
+    return df_rt_next_stop
+
+
+def fetch_realtime_updates():
+    """GTFS-RTデータをrequestsで取得し、DataFrameとして返す (再試行はRT_SESSIONのRetryに任せる)"""
+    try:
+        # 前回取得分があれば条件付きGETにし、未更新 (304) ならパースを省略して前回の結果を返す
+        conditional_headers = {}
+        if RT_CACHE['df'] is not None:
+            if RT_CACHE['etag']:
+                conditional_headers['If-None-Match'] = RT_CACHE['etag']
+            if RT_CACHE['last_modified']:
+                conditional_headers['If-Modified-Since'] = RT_CACHE['last_modified']
+
+        # ★共有セッションでアクセス（keep-aliveで接続を再利用）
+        res = RT_SESSION.get(
+            GTFS_RT_URL, 
+            headers=conditional_headers,
+            timeout=TIMEOUT_SECONDS # 設定したタイムアウトを適用
+        )
+        if res.status_code == 304 and RT_CACHE['df'] is not None:
+            return RT_CACHE['df']
+        res.raise_for_status() # HTTPエラー (4xx, 5xx) を例外として処理
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(res.content) # .content でバイナリデータを取得
+
+        # 1行ごとのdictは作らず、stop_time_updateの総数で確保した列配列に直接書き込む
+        trip_updates = [entity.trip_update for entity in feed.entity if entity.HasField('trip_update')]
+        n_updates = sum(len(tu.stop_time_update) for tu in trip_updates)
+        trip_ids = np.empty(n_updates, dtype=object)
+        stop_sequences = np.empty(n_updates, dtype=np.int32)
+        delays = np.empty(n_updates, dtype=np.int32)
+        rt_stop_ids = np.empty(n_updates, dtype=object)
+
+        n = 0
+        for tu in trip_updates:
+            trip_id = tu.trip.trip_id
             
-            # インデント修正済み
-            if updates:
-                return pd.DataFrame(updates)
-            else:
-                return pd.DataFrame(columns=['trip_id', 'stop_sequence', 'delay_sec', 'rt_stop_id'])
-
-        except requests.exceptions.Timeout:
-            print(f"GTFS-RT取得エラー (Attempt {attempt+1}): [requests ERROR] 理由: 接続または読み込みタイムアウト ({TIMEOUT_SECONDS}秒)")
-            slp(1)
-        except requests.exceptions.RequestException as e:
-            # 接続、HTTPエラー (4xx, 5xx) など
-            print(f"GTFS-RT取得エラー (Attempt {attempt+1}): [requests ERROR] 詳細: {e}")
-            slp(1)
-        except Exception as e:
-            print(f"GTFS-RT取得エラー (Attempt {attempt+1}): [OTHER ERROR] 詳細: {e}")
-            slp(1)
+            for stu in tu.stop_time_update:
+                delay = 0
+                if stu.HasField('departure') and stu.departure.HasField('delay'):
+                    delay = stu.departure.delay
+                elif stu.HasField('arrival') and stu.arrival.HasField('delay'):
+                    delay = stu.arrival.delay
+                
+                if delay != 0 or stu.HasField('stop_id'):
+                    trip_ids[n] = trip_id
+                    stop_sequences[n] = stu.stop_sequence
+                    delays[n] = delay
+                    rt_stop_ids[n] = stu.stop_id
+                    n += 1
+        
+        df_rt = pd.DataFrame({
+            'trip_id': trip_ids[:n],
+            'stop_sequence': stop_sequences[:n],
+            'delay_sec': delays[:n],
+            'rt_stop_id': rt_stop_ids[:n]
+        }, copy=False)
+
+        RT_CACHE['etag'] = res.headers.get('ETag')
+        RT_CACHE['last_modified'] = res.headers.get('Last-Modified')
+        return df_rt
+
+    except requests.exceptions.Timeout:
+        print(f"GTFS-RT取得エラー: [requests ERROR] 理由: 接続または読み込みタイムアウト ({TIMEOUT_SECONDS}秒)")
+    except requests.exceptions.RequestException as e:
+        # 接続、HTTPエラー (4xx, 5xx)、再試行の上限到達など
+        print(f"GTFS-RT取得エラー: [requests ERROR] 詳細: {e}")
+    except Exception as e:
+        print(f"GTFS-RT取得エラー: [OTHER ERROR] 詳細: {e}")
             
     print("GTFS-RTデータの取得に失敗しました。空のDataFrameを返します。")
+    # 空の結果に対して304を受け取らないよう検証子を破棄する
+    RT_CACHE['etag'] = None
+    RT_CACHE['last_modified'] = None
     return pd.DataFrame()
 
 
+def judge_status_codes(delay_sec, judgetime_sec, departure_sec, arr_sec, is_on_time, now_time_sec):
+    """各便の運行状況をSTATUS_*コードのint8配列で判定する (引数はNumPy配列)"""
+    has_rt = ~np.isnan(delay_sec)
+    is_upcoming = judgetime_sec > now_time_sec
+    return np.select(
+        [
+            has_rt & is_upcoming & is_on_time,
+            has_rt & is_upcoming,
+            has_rt,
+            departure_sec > now_time_sec,
+            arr_sec < now_time_sec
+        ],
+        [STATUS_ARRIVING_ON_TIME, STATUS_ARRIVING, STATUS_PASSED, STATUS_NOT_STARTED, STATUS_FINISHED],
+        default=STATUS_PASSED_NO_INFO
+    ).astype(np.int8)
+
+
 def generate_schedule(stop_name):
+    """指定されたバス停の運行表を返す。SCHEDULE_CACHE_SECONDS以内に生成済みであればそれを使い回す"""
+    with SCHEDULE_CACHE_LOCK:
+        cached = SCHEDULE_CACHE.get(stop_name)
+    if cached is not None and time.monotonic() - cached[1] < SCHEDULE_CACHE_SECONDS:
+        return cached[0]
+
+    final_list = build_schedule(stop_name)
+
+    # 存在しないバス停名はキャッシュしない (任意のURLでキャッシュが膨らむのを防ぐ)
+    if stop_name in GTFS.get('PARENT_ID_MAP', {}):
+        with SCHEDULE_CACHE_LOCK:
+            SCHEDULE_CACHE[stop_name] = (final_list, time.monotonic())
+    return final_list
+
+
+def build_schedule(stop_name):
     """指定されたバス停（親ID）のリアルタイム運行表を生成する"""
     
     if not GTFS: return []
@@ -185,173 +411,116 @@ def generate_schedule(stop_name):
     now_time_sec = now_jst.hour * 3600 + now_jst.minute * 60 + now_jst.second
     
     active_service_ids = get_current_service_ids(now_jst)
-    if not active_service_ids: return []
-
-    df_trips_today = GTFS['TRIPS'][GTFS['TRIPS']['service_id'].isin(active_service_ids)]
+    if len(active_service_ids) == 0: return []
 
-    df_schedule = GTFS['STOP_TIMES'].merge(
-        df_trips_today[['trip_id', 'trip_headsign']],
-        on='trip_id',
-        how='inner'
-    )
-    
     target_parent_id = GTFS['PARENT_ID_MAP'].get(stop_name)
     if not target_parent_id: return [] 
 
-    all_target_stop_ids = GTFS['STOPS'][
-        GTFS['STOPS']['parent_id'] == target_parent_id
-    ]['stop_id'].tolist()
-    
-    df_stop_schedule = df_schedule[
-        df_schedule['stop_id'].isin(all_target_stop_ids)
-    ].copy()
+    df_parent_schedule = GTFS['SCHEDULE_BY_PARENT'].get(target_parent_id)
+    if df_parent_schedule is None: return []
 
-    df_rt_all = get_realtime_updates() 
+    # 便ごとの次に到着するバス停の行。その1つ前のバス停を現在地とする
+    df_rt_next_stop = get_rt_next_stops()
 
-    if df_rt_all.empty:
-        df_stop_schedule['delay_sec'] = np.nan
-        df_stop_schedule['now_stop'] = '-'
-        df_stop_schedule['now_stop_id'] = np.nan 
+    # バス停ごとの時刻表は出発時刻順 (欠損は末尾) に並んでいるため、30分前以降の開始位置は二分探索で求める
+    # それより前の便はRTで遅れている/未到着の便しか残らないため、判定の前に除外しておく
+    # キャッシュ済みの時刻表は変更せず、RT由来の値は別の配列として持つ (コピー不要)
+    cutoff_sec = now_time_sec - 1800 
+    start = int(np.searchsorted(df_parent_schedule['departure_sec'].to_numpy(), cutoff_sec))
+    in_window = np.arange(len(df_parent_schedule)) >= start
+    if not df_rt_next_stop.empty:
+        in_window[:start] = df_parent_schedule['trip_id'].iloc[:start].isin(df_rt_next_stop['trip_id']).to_numpy()
+    selected = in_window & df_parent_schedule['service_id'].isin(active_service_ids).to_numpy()
+    df_stop_schedule = df_parent_schedule[selected]
+    trip_ids = df_stop_schedule['trip_id']
+
+    # このバス停の便がRTに1件も含まれなければ、RTなしと同じ扱いにして便ごとの辞書作成を省く
+    use_rt = not df_rt_next_stop.empty and bool(trip_ids.isin(df_rt_next_stop['trip_id']).any())
+
+    if not use_rt:
+        delay_sec = np.full(len(df_stop_schedule), np.nan)
     else:
-        df_rt_next_stop = df_rt_all.sort_values('stop_sequence').drop_duplicates(
-            subset=['trip_id'], keep='first'
-        )
-        
-        df_rt_next_stop = df_rt_next_stop[[
-            'trip_id', 
-            'stop_sequence', 
-            'delay_sec'
-        ]].rename(columns={'stop_sequence': 'next_stop_sequence'}).copy()
-        
-        df_stop_static_for_merge = GTFS['STOP_TIMES'][['trip_id', 'stop_sequence', 'stop_id']].copy()
-        
-        df_rt_current_info = df_rt_next_stop.merge(
-            df_stop_static_for_merge,
-            on=['trip_id'],
-            how='left'
-        )
-        
-        df_rt_current_info['current_stop_sequence'] = df_rt_current_info['next_stop_sequence'] - 1
-        
-        df_rt_current_stop = df_rt_current_info[
-            (df_rt_current_info['stop_sequence'] == df_rt_current_info['current_stop_sequence']) & 
-            (df_rt_current_info['stop_sequence'] >= 0) 
-        ].copy()
-        
-        df_rt_final = df_rt_current_stop[[
-            'trip_id', 
-            'stop_id', 
-            'delay_sec' 
-        ]].rename(columns={'stop_id': 'now_stop_id'}).copy()
-        
-        df_delay_info_min_seq = df_rt_next_stop[['trip_id', 'delay_sec']].drop_duplicates(subset=['trip_id'], keep='first')
-        
-        df_rt_info_to_merge = df_delay_info_min_seq.merge(
-            df_rt_final[['trip_id', 'now_stop_id']].drop_duplicates(subset=['trip_id'], keep='first'),
-            on='trip_id',
-            how='left'
-        )
-        
-        df_stop_schedule = df_stop_schedule.merge(
-            df_rt_info_to_merge[['trip_id', 'delay_sec', 'now_stop_id']],
-            on='trip_id',
-            how='left'
-        )
-        
-        stop_name_map = GTFS.get('STOP_NAME_MAP', {})
-        df_stop_schedule['now_stop_base'] = df_stop_schedule['now_stop_id'].map(stop_name_map)
-        
-        def format_now_stop(row):
-            base_name = row['now_stop_base']
-            now_stop_id = row['now_stop_id']
-            
-            if pd.isna(row['delay_sec']):
-                return '-'
+        trip_seq_stop = GTFS['TRIP_SEQ_STOP']
+        delay_by_trip = dict(zip(df_rt_next_stop['trip_id'], df_rt_next_stop['delay_sec']))
+        now_stop_by_trip = {
+            trip_id: trip_seq_stop.get((trip_id, seq - 1))
+            for trip_id, seq in zip(df_rt_next_stop['trip_id'], df_rt_next_stop['stop_sequence'])
+        }
+        delay_sec = trip_ids.map(delay_by_trip).to_numpy(dtype=np.float64)
+
+    # 以降の判定・絞り込み・並べ替えは必要な列だけをNumPy配列として処理する
+    departure_sec = df_stop_schedule['departure_sec'].to_numpy(dtype=np.float64)
+    arr_sec = trip_ids.map(GTFS['TRIP_ARR_SEC']).to_numpy(dtype=np.float64)
+    has_rt = ~np.isnan(delay_sec)
+    judgetime_sec = departure_sec + np.nan_to_num(delay_sec)
+
+    status = judge_status_codes(
+        delay_sec,
+        judgetime_sec,
+        departure_sec,
+        arr_sec,
+        has_rt & (np.abs(delay_sec) < 60), # 1分未満の遅れ・早着は定刻扱い
+        now_time_sec
+    )
 
-            if pd.notna(base_name):
-                return f"{base_name}を通過"
-            elif pd.notna(now_stop_id):
-                return f"{now_stop_id}付近"
-            else:
-                return '始点付近'
+    # 30分前以降の便、およびRT上まだ到着していない便を残す (元の並びが出発時刻順のため並べ替えは不要)
+    order = np.flatnonzero((judgetime_sec >= cutoff_sec) | (has_rt & (status != STATUS_PASSED)))
 
-        df_stop_schedule['now_stop'] = df_stop_schedule.apply(format_now_stop, axis=1)
-        
-    df_stop_schedule = df_stop_schedule.merge(
-        GTFS['TRIP_BOUNDARIES'],
-        on='trip_id',
-        how='left'
-    )
+    # 現在地の文言は表示する行だけ組み立てる
+    if not use_rt:
+        now_stop = np.full(len(order), '-', dtype=object)
+    else:
+        now_stop_id = trip_ids.iloc[order].map(now_stop_by_trip)
+        now_stop_base = now_stop_id.map(GTFS['STOP_NAME_SERIES'])
+        now_stop = np.select(
+            [
+                np.isnan(delay_sec[order]),
+                now_stop_base.notna(),
+                now_stop_id.notna()
+            ],
+            [
+                '-',
+                now_stop_base.astype(str) + 'を通過',
+                now_stop_id.astype(str) + '付近'
+            ],
+            default='始点付近'
+        )
 
-    df_stop_schedule['judgetime_sec'] = df_stop_schedule['departure_sec'] + df_stop_schedule['delay_sec'].fillna(0)
-    
-    def format_delay_time(delay_sec):
-        if pd.isna(delay_sec): return "運行情報なし"
-        if abs(delay_sec) < 60: return "定刻"
-        
-        delay_min = int(delay_sec / 60)
-        
-        if delay_min > 0: return f"{delay_min}分遅れ"
-        elif delay_min < 0: return f"{abs(delay_min)}分早着"
-        else: return "定刻"
-            
-    df_stop_schedule['delay_time'] = df_stop_schedule['delay_sec'].apply(format_delay_time)
-
-    def judge_status(row):
-        judgetime_sec = row['judgetime_sec']
-        delay_time = row['delay_time']
-        target_dep_sec = row['departure_sec'] 
-        arr_sec = row['arr_sec']               
-
-        if pd.notna(row['delay_sec']):
-            if judgetime_sec > now_time_sec:
-                remaining_sec = judgetime_sec - now_time_sec
-                remaining_min = int(np.ceil(remaining_sec / 60))
-                remaining_min = max(1, remaining_min) 
-                
-                if delay_time == "定刻":
-                    return f"あと{remaining_min}分で定刻到着見込み。"
-                else:
-                    return f"あと{remaining_min}分で到着見込み。({delay_time})"
-            else:
-                return "通過・到着済み"
-        else:
-            if target_dep_sec > now_time_sec:
-                return "運行開始前" 
-            if arr_sec < now_time_sec:
-                return "運行終了"
-            return "通過済み（情報なし）" 
-
-
-    df_stop_schedule['info'] = df_stop_schedule.apply(judge_status, axis=1)
+    # 運行状況の文言: 到着見込みの行だけ残り分数（最低1分）と遅延分数（0方向に切り捨て）を組み立てる
+    status = status[order]
+    info = STATUS_LABELS[status]
+    arriving = status <= STATUS_ARRIVING
+    arriving_idx = order[arriving]
+    remaining_min = pd.Series(
+        np.maximum(1, np.ceil((judgetime_sec[arriving_idx] - now_time_sec) / 60)).astype(int)
+    ).astype(str)
+    delay_min = np.trunc(delay_sec[arriving_idx] / 60).astype(int)
+    delay_min_abs = pd.Series(np.abs(delay_min)).astype(str)
+    delay_time = pd.Series(
+        np.where(delay_min > 0, delay_min_abs + '分遅れ', delay_min_abs + '分早着'), dtype=str
+    )
+    info[arriving] = np.where(
+        status[arriving] == STATUS_ARRIVING_ON_TIME,
+        'あと' + remaining_min + '分で定刻到着見込み。',
+        'あと' + remaining_min + '分で到着見込み。(' + delay_time + ')'
+    )
 
-    cutoff_sec = now_time_sec - 1800 
+    final = np.column_stack([
+        df_stop_schedule['departure_time'].to_numpy(dtype=object)[order],
+        df_stop_schedule['trip_headsign'].to_numpy(dtype=object)[order],
+        now_stop,
+        info
+    ])
     
-    df_final_filtered = df_stop_schedule[
-        (df_stop_schedule['judgetime_sec'] >= cutoff_sec) | 
-        (pd.notna(df_stop_schedule['delay_sec']) & (df_stop_schedule['info'] != '通過・到着済み'))
-    ].copy() 
-
-    df_final_sorted = df_final_filtered.sort_values(by='departure_sec')
-
-    final_list = df_final_sorted[[
-        'departure_time', 
-        'trip_headsign', 
-        'now_stop', 
-        'info'
-    ]].values.tolist()
+    # 欠損値はテンプレート側で扱いやすいようNoneに置き換える
+    final[pd.isna(final)] = None
     
-    final_list = [
-        [None if pd.isna(item) else item for item in row] 
-        for row in final_list
-    ]
-    
-    return final_list
+    return final.tolist()
 
 
 # --- Flask アプリケーション ---
 app = Flask(__name__)
-app.config ['TEMPLATES_AUTO_RELOAD'] = True
+app.config ['TEMPLATES_AUTO_RELOAD'] = None # None: debug時のみテンプレートを自動再読み込みする (本番では毎回のファイル確認を省く)
 
 # GTFSデータはメモリ内で定義済みのため、アプリケーション起動時にロードする
 load_gtfs_data() 